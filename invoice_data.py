@@ -1,12 +1,17 @@
 import streamlit as st
 import google.generativeai as genai
 import json
+import orjson
 import os
+import hashlib
+import shelve
+import threading
 from pathlib import Path
 from datetime import datetime
-import base64
-from PIL import Image
+from operator import itemgetter
+from PIL import Image, ImageOps
 import io
+import pandas as pd
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -17,8 +22,15 @@ st.set_page_config(page_title="Invoice Data Extractor", layout="wide")
 # Initialize session state
 if 'extraction_result' not in st.session_state:
     st.session_state.extraction_result = None
-if 'uploaded_image' not in st.session_state:
-    st.session_state.uploaded_image = None
+if 'uploaded_bytes' not in st.session_state:
+    st.session_state.uploaded_bytes = None
+if 'uploaded_mime' not in st.session_state:
+    st.session_state.uploaded_mime = None
+if 'encoded_bytes' not in st.session_state:
+    st.session_state.encoded_bytes = None
+
+# Gemini model used for extraction
+GEMINI_MODEL = 'gemini-2.0-flash'
 
 # Configure Gemini API
 @st.cache_resource
@@ -28,7 +40,8 @@ def setup_gemini():
         st.error("Please set GEMINI_API_KEY in secrets or environment variables")
         st.stop()
     genai.configure(api_key=api_key)
-    return genai.GenerativeModel('gemini-2.0-flash')
+    # Bind the prompt as a system instruction so each request only carries the image
+    return genai.GenerativeModel(GEMINI_MODEL, system_instruction=EXTRACTION_PROMPT)
 
 # Create results directory
 def ensure_results_dir():
@@ -36,6 +49,28 @@ def ensure_results_dir():
     results_dir.mkdir(exist_ok=True)
     return results_dir
 
+# List saved result files, newest first (cached briefly across reruns)
+@st.cache_data(ttl=5, show_spinner=False)
+def list_results(dir_str):
+    with os.scandir(dir_str) as it:
+        entries = [(e.path, e.stat().st_mtime) for e in it if e.name.endswith(".json") and e.is_file()]
+    entries.sort(key=itemgetter(1), reverse=True)
+    return [path for path, _ in entries]
+
+# Create extraction cache directory
+def ensure_cache_dir():
+    cache_dir = ensure_results_dir() / ".cache"
+    cache_dir.mkdir(exist_ok=True)
+    return cache_dir
+
+# Image preprocessing settings (Gemini tiles images internally, so full resolution is wasted)
+MAX_IMAGE_SIZE = (1600, 1600)
+JPEG_QUALITY = 85
+PASSTHROUGH_MIME_TYPES = {"image/jpeg", "image/png"}
+
+# Maximum number of extraction results memoized in process memory
+EXTRACTION_MEMO_ENTRIES = 64
+
 # High-quality extraction prompt
 EXTRACTION_PROMPT = """
 You are an expert invoice data extraction system. Analyze the provided invoice image and extract ALL requested information with high precision and accuracy.
@@ -88,42 +123,180 @@ CRITICAL REQUIREMENTS:
 - Double-check all arithmetic calculations
 - Extract all visible items from the invoice"""
 
+# Response schema mirroring the JSON structure in EXTRACTION_PROMPT
+NULLABLE_STRING = {"type": "string", "nullable": True}
+NULLABLE_NUMBER = {"type": "number", "nullable": True}
+
+INVOICE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "shop_info": {
+            "type": "object",
+            "properties": {
+                "shop_name": NULLABLE_STRING,
+                "shop_address": NULLABLE_STRING,
+                "shop_contact_numbers": {"type": "array", "items": {"type": "string"}},
+                "shop_email": NULLABLE_STRING
+            },
+            "required": ["shop_name", "shop_address", "shop_contact_numbers", "shop_email"]
+        },
+        "invoice_details": {
+            "type": "object",
+            "properties": {
+                "receipt_number": NULLABLE_STRING,
+                "invoice_number": NULLABLE_STRING,
+                "invoice_date": NULLABLE_STRING,
+                "invoice_subtotal": NULLABLE_NUMBER,
+                "invoice_total": NULLABLE_NUMBER,
+                "invoice_total_discount": NULLABLE_NUMBER,
+                "item_count": {"type": "integer", "nullable": True}
+            },
+            "required": [
+                "receipt_number", "invoice_number", "invoice_date", "invoice_subtotal",
+                "invoice_total", "invoice_total_discount", "item_count"
+            ]
+        },
+        "line_items": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "item_code": NULLABLE_STRING,
+                    "item_name": NULLABLE_STRING,
+                    "quantity": {"type": "number"},
+                    "unit_price": {"type": "number"},
+                    "discount": {"type": "number"},
+                    "tax": {"type": "number"},
+                    "item_total_amount": {"type": "number"}
+                },
+                "required": [
+                    "item_code", "item_name", "quantity", "unit_price",
+                    "discount", "tax", "item_total_amount"
+                ]
+            }
+        }
+    },
+    "required": ["shop_info", "invoice_details", "line_items"]
+}
+
+# Precomputed digest of the model, prompt and schema for extraction cache keys
+EXTRACTION_PROMPT_BYTES = EXTRACTION_PROMPT.encode('utf-8')
+EXTRACTION_CONFIG_HASH = hashlib.blake2b(
+    GEMINI_MODEL.encode('utf-8') + b"\0" + EXTRACTION_PROMPT_BYTES + orjson.dumps(INVOICE_SCHEMA),
+    digest_size=8
+).digest()
+
+# Lock serializing access to the extraction cache (shelve is not thread-safe)
+@st.cache_resource
+def get_cache_lock():
+    return threading.Lock()
+
+# Look up a previous extraction result, treating any cache error as a miss
+def read_cached_extraction(key):
+    try:
+        with get_cache_lock(), shelve.open(str(ensure_cache_dir() / "extractions")) as cache:
+            return cache.get(key)
+    except Exception as e:
+        print(f"Extraction cache read failed: {e}")  # Debug log
+        return None
+
+# Store an extraction result, ignoring cache errors so the result is still returned
+def write_cached_extraction(key, data):
+    try:
+        with get_cache_lock(), shelve.open(str(ensure_cache_dir() / "extractions")) as cache:
+            cache[key] = data
+    except Exception as e:
+        print(f"Extraction cache write failed: {e}")  # Debug log
+
+# Run Gemini extraction, reusing prior results for identical images unless refresh is set
+def run_extraction(image_bytes, mime_type, refresh=False):
+    hasher = hashlib.blake2b(image_bytes, digest_size=16)
+    hasher.update(EXTRACTION_CONFIG_HASH)
+    key = hasher.hexdigest()
+    
+    if not refresh:
+        cached_data = read_cached_extraction(key)
+        if cached_data is not None:
+            print("Using cached extraction result.")  # Debug log
+            return cached_data
+    
+    model = setup_gemini()
+    
+    # Prepare image for Gemini (the SDK handles transport encoding)
+    image_part = {
+        "mime_type": mime_type,
+        "data": image_bytes
+    }
+    
+    # Send to Gemini, constraining output to the invoice schema
+    response = model.generate_content(
+        [image_part],
+        generation_config={
+            "response_mime_type": "application/json",
+            "response_schema": INVOICE_SCHEMA
+        }
+    )
+    
+    # Parse JSON response
+    extracted_data = orjson.loads(response.text)
+    
+    write_cached_extraction(key, extracted_data)
+    return extracted_data
+
+# In-process memo of run_extraction for repeat extractions on this server
+@st.cache_data(
+    show_spinner=False,
+    max_entries=EXTRACTION_MEMO_ENTRIES,
+    hash_funcs={bytes: lambda b: hashlib.blake2b(b).digest()}
+)
+def memoized_extraction(image_bytes, mime_type):
+    return run_extraction(image_bytes, mime_type)
+
+# Prepare image bytes for Gemini, only decoding when they need resizing or re-encoding
+def prepare_image(image_bytes, mime_type):
+    image = Image.open(io.BytesIO(image_bytes))
+    if mime_type in PASSTHROUGH_MIME_TYPES and image.width <= MAX_IMAGE_SIZE[0] and image.height <= MAX_IMAGE_SIZE[1]:
+        return image_bytes, mime_type
+    
+    # Apply EXIF orientation, since the JPEG re-encode drops the EXIF tag
+    image = ImageOps.exif_transpose(image)
+    
+    # Flatten to RGB before resizing: transparent areas become white rather than
+    # their hidden (often black) colour, and LANCZOS is not applied to palette modes
+    if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image).convert("RGB")
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    
+    # Downscale and recompress image for API
+    image.thumbnail(MAX_IMAGE_SIZE, Image.Resampling.LANCZOS)
+    
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+    return buffer.getvalue(), "image/jpeg"
+
 # Extract data from invoice using Gemini
-def extract_invoice_data(image_data):
+def extract_invoice_data(image_bytes, mime_type, file_id=None, refresh=False):
     try:
         print("Starting data extraction...")  # Debug log
-        model = setup_gemini()
         
-        # Convert image to base64 for API
-        if isinstance(image_data, bytes):
-            image_bytes = image_data
+        # Reuse the encoded image if this upload was already processed in the session
+        cached = st.session_state.encoded_bytes
+        if file_id is not None and cached and cached[0] == file_id:
+            _, image_bytes, mime_type = cached
         else:
-            buffer = io.BytesIO()
-            image_data.save(buffer, format='PNG')
-            image_bytes = buffer.getvalue()
-        
-        # Prepare image for Gemini
-        image_part = {
-            "mime_type": "image/png",
-            "data": base64.standard_b64encode(image_bytes).decode()
-        }
-        
-        # Send to Gemini
-        response = model.generate_content([EXTRACTION_PROMPT, image_part])
+            image_bytes, mime_type = prepare_image(image_bytes, mime_type)
+            if file_id is not None:
+                st.session_state.encoded_bytes = (file_id, image_bytes, mime_type)
         
-        # Parse JSON response
-        response_text = response.text.strip()
-        
-        # Remove markdown code blocks if present
-        if response_text.startswith("```json"):
-            response_text = response_text[7:]
-        if response_text.startswith("```"):
-            response_text = response_text[3:]
-        if response_text.endswith("```"):
-            response_text = response_text[:-3]
-        
-        extracted_data = json.loads(response_text.strip())
-        return extracted_data
+        if refresh:
+            # Bypass both cache layers, overwrite the stored result and drop stale memoized entries
+            extracted_data = run_extraction(image_bytes, mime_type, refresh=True)
+            memoized_extraction.clear()
+            return extracted_data
+        return memoized_extraction(image_bytes, mime_type)
     
     except json.JSONDecodeError as e:
         st.error(f"Failed to parse JSON response: {e}")
@@ -132,8 +305,8 @@ def extract_invoice_data(image_data):
         st.error(f"Error extracting data: {e}")
         return None
 
-# Save extracted data to JSON file
-def save_extraction_result(data, filename=None):
+# Save serialized extraction data to JSON file
+def save_extraction_result(data, payload, filename=None):
     print("Saving extraction result...")  # Debug log
     results_dir = ensure_results_dir()
     
@@ -144,11 +317,26 @@ def save_extraction_result(data, filename=None):
     
     filepath = results_dir / filename
     
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    filepath.write_bytes(payload)
+    list_results.clear()
     
     return filepath
 
+# Currency formatter for display values
+format_money = "${:.2f}".format
+
+# Line item fields and their display column names
+LINE_ITEM_COLUMNS = {
+    "item_code": "Code",
+    "item_name": "Item Name",
+    "quantity": "Qty",
+    "unit_price": "Unit Price",
+    "discount": "Discount",
+    "tax": "Tax",
+    "item_total_amount": "Total"
+}
+MONEY_COLUMNS = ("Unit Price", "Discount", "Tax", "Total")
+
 # Display extracted data
 def display_extracted_data(data):
     if not data:
@@ -178,9 +366,6 @@ def display_extracted_data(data):
         st.write(f"**Date:** {invoice_details.get('invoice_date', 'N/A')}")
         st.write(f"**Item Count:** {invoice_details.get('item_count', 'N/A')}")
     
-    st.subheader("💰 Financial Summary")
-    col1, col2, col3, col4 = st.columns(4)
-    
     # Helper function to safely get numeric values
     def safe_float(value, default=0.0):
         if value is None:
@@ -190,37 +375,38 @@ def display_extracted_data(data):
         except (ValueError, TypeError):
             return default
     
+    # Build the line items table as a single DataFrame with vectorized numeric parsing
+    items_df = pd.DataFrame(data.get("line_items") or [])
+    items_df = items_df.reindex(columns=list(LINE_ITEM_COLUMNS)).rename(columns=LINE_ITEM_COLUMNS)
+    for col in ("Qty", *MONEY_COLUMNS):
+        items_df[col] = pd.to_numeric(items_df[col], errors="coerce").fillna(0.0)
+    total_tax = float(items_df["Tax"].sum())
+    
+    items_df["Code"] = items_df["Code"].replace({"": None}).fillna("N/A")
+    items_df["Item Name"] = items_df["Item Name"].fillna("N/A")
+    for col in MONEY_COLUMNS:
+        items_df[col] = items_df[col].map(format_money)
+    items_df.insert(0, "#", range(1, len(items_df) + 1))
+    
+    st.subheader("💰 Financial Summary")
+    col1, col2, col3, col4 = st.columns(4)
+    
     with col1:
         subtotal = safe_float(invoice_details.get('invoice_subtotal'))
-        st.metric("Subtotal", f"${subtotal:.2f}")
+        st.metric("Subtotal", format_money(subtotal))
     with col2:
         discount = safe_float(invoice_details.get('invoice_total_discount'))
-        st.metric("Total Discount", f"${discount:.2f}")
+        st.metric("Total Discount", format_money(discount))
     with col3:
-        total_tax = sum(safe_float(item.get('tax', 0)) for item in data.get('line_items', []))
-        st.metric("Total Tax", f"${total_tax:.2f}")
+        st.metric("Total Tax", format_money(total_tax))
     with col4:
         total = safe_float(invoice_details.get('invoice_total'))
-        st.metric("TOTAL", f"${total:.2f}", delta=None)
+        st.metric("TOTAL", format_money(total), delta=None)
     
     # Display line items
-    if data.get("line_items"):
+    if not items_df.empty:
         st.subheader("📦 Line Items")
-        
-        items_data = []
-        for idx, item in enumerate(data.get("line_items", []), 1):
-            items_data.append({
-                "#": idx,
-                "Code": item.get("item_code") or "N/A",
-                "Item Name": item.get("item_name", "N/A"),
-                "Qty": safe_float(item.get("quantity")),
-                "Unit Price": f"${safe_float(item.get('unit_price')):.2f}",
-                "Discount": f"${safe_float(item.get('discount')):.2f}",
-                "Tax": f"${safe_float(item.get('tax')):.2f}",
-                "Total": f"${safe_float(item.get('item_total_amount')):.2f}"
-            })
-        
-        st.dataframe(items_data, use_container_width=True)
+        st.dataframe(items_df, use_container_width=True, hide_index=True)
 
 # Main app
 st.title("🧾 Invoice Data Extraction System")
@@ -244,24 +430,40 @@ with tab1:
     )
     
     if uploaded_file:
-        st.session_state.uploaded_image = Image.open(uploaded_file)
+        st.session_state.uploaded_bytes = uploaded_file.getvalue()
+        st.session_state.uploaded_mime = uploaded_file.type
         
         col1, col2 = st.columns([1, 1])
         
         with col1:
-            st.image(st.session_state.uploaded_image, caption="Uploaded Invoice", use_container_width=True)
+            st.image(st.session_state.uploaded_bytes, caption="Uploaded Invoice", use_container_width=True)
         
         with col2:
-            if st.button("🔍 Extract Data", use_container_width=True, type="primary"):
+            extract_clicked = st.button("🔍 Extract Data", use_container_width=True, type="primary")
+            refresh_clicked = st.button(
+                "🔄 Re-extract (ignore cache)",
+                use_container_width=True,
+                help="Send the invoice to Gemini again instead of reusing a cached result"
+            )
+            
+            if extract_clicked or refresh_clicked:
                 with st.spinner("Extracting invoice data..."):
-                    extraction_result = extract_invoice_data(st.session_state.uploaded_image)
+                    extraction_result = extract_invoice_data(
+                        st.session_state.uploaded_bytes,
+                        st.session_state.uploaded_mime,
+                        uploaded_file.file_id,
+                        refresh=refresh_clicked
+                    )
                     print("Extraction is complete.")  # Debug log
                     
                     if extraction_result:
                         st.session_state.extraction_result = extraction_result
                         
+                        # Serialize once for both the saved file and the download
+                        payload = orjson.dumps(extraction_result, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+                        
                         # Save to file
-                        filepath = save_extraction_result(extraction_result)
+                        filepath = save_extraction_result(extraction_result, payload)
                         print(f"Data saved to {filepath}")  # Debug log
                         st.success(f"✅ Data extracted successfully!")
                         st.info(f"📁 Saved to: `{filepath}`")
@@ -272,10 +474,9 @@ with tab1:
                         
                         # Download options
                         st.subheader("📥 Download Results")
-                        json_str = json.dumps(extraction_result, indent=2, ensure_ascii=False)
                         st.download_button(
                             label="Download as JSON",
-                            data=json_str,
+                            data=payload,
                             file_name=f"invoice_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
                             mime="application/json"
                         )
@@ -284,12 +485,9 @@ with tab2:
     st.subheader("📋 Extraction Results")
     
     results_dir = ensure_results_dir()
-    results_files = list(results_dir.glob("*.json"))
+    results_files = [Path(f) for f in list_results(str(results_dir))]
     
     if results_files:
-        # Sort by modification time, newest first
-        results_files.sort(key=lambda x: x.stat().st_mtime, reverse=True)
-        
         selected_file = st.selectbox(
             "Select a result file",
             results_files,
@@ -297,18 +495,25 @@ with tab2:
         )
         
         if selected_file:
-            with open(selected_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            st.write(f"**File:** {selected_file.name}")
-            st.write(f"**Modified:** {datetime.fromtimestamp(selected_file.stat().st_mtime).strftime('%Y-%m-%d %H:%M:%S')}")
-            
-            st.divider()
-            
-            display_extracted_data(data)
+            try:
+                data = orjson.loads(selected_file.read_bytes())
+                modified = selected_file.stat().st_mtime
+            except FileNotFoundError:
+                # The cached listing may name a file removed since it was built
+                list_results.clear()
+                data = None
+                st.info(f"📭 `{selected_file.name}` is no longer available. Reselect a result file.")
             
-            # Raw JSON viewer
-            with st.expander("📄 Raw JSON Data"):
-                st.json(data)
+            if data is not None:
+                st.write(f"**File:** {selected_file.name}")
+                st.write(f"**Modified:** {datetime.fromtimestamp(modified).strftime('%Y-%m-%d %H:%M:%S')}")
+                
+                st.divider()
+                
+                display_extracted_data(data)
+                
+                # Raw JSON viewer, only rendered on request to avoid sending large payloads to the frontend
+                if st.toggle("📄 Show Raw JSON Data", key=f"view_{selected_file.name}"):
+                    st.json(data)
     else:
         st.info("📭 No extraction results found. Upload an invoice and extract data to see results here.")
\ No newline at end of file